@@ -21,13 +21,22 @@ def download_conversion_tool():
         return repo_path
     
     print("📥 Cloning conversion tool from GitHub...")
+    # Shallow partial clone: only the latest commit, blobs fetched on demand,
+    # and only project/Yolov4 checked out
     cmd = [
         "git", "clone",
+        "--depth", "1",
+        "--filter=blob:none",
+        "--sparse",
         "https://github.com/linghu8812/tensorrt_inference.git"
     ]
     
     try:
         subprocess.run(cmd, check=True)
+        subprocess.run(
+            ["git", "-C", str(repo_path), "sparse-checkout", "set", "project/Yolov4"],
+            check=True
+        )
         print(f"✅ Successfully cloned to: {repo_path}")
         return repo_path
     except subprocess.CalledProcessError as e:
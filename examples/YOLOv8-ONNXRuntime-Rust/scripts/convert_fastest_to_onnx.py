@@ -14,6 +14,7 @@ Alternative: Manual PyTorch Implementation
 
 Requirements:
     pip install torch torchvision opencv-python numpy onnx
+    pip install onnxconverter-common  # only for --fp16
 
 Usage:
     # Activate virtual environment first
@@ -22,6 +23,7 @@ Usage:
     
     # Run conversion
     python scripts/convert_fastest_to_onnx.py
+    python scripts/convert_fastest_to_onnx.py --fp16  # also write *_fp16.onnx
 
 Models:
     - YOLO-Fastest-1.1 (0.35M params, 1.3MB)
@@ -33,6 +35,9 @@ Note: Check ModelZoo for available formats:
     models/yolo-fastest-1.1/yolo-fastest-1.1-xl.{weights,cfg}
 """
 
+import argparse
+import configparser
+import itertools
 import os
 import sys
 import torch
@@ -40,6 +45,11 @@ import torch.nn as nn
 import numpy as np
 import onnx
 from pathlib import Path
+from torch.ao.quantization import fuse_modules
+
+from onnx_utils import (
+    atomic_write, convert_to_fp16, export_onnx, fp16_available, model_size_mb, optimize_onnx, save_with_external_data,
+)
 
 # Add models directory to path
 MODELS_DIR = Path(__file__).parent.parent / "models"
@@ -48,7 +58,8 @@ MODELS_DIR = Path(__file__).parent.parent / "models"
 class YOLOFastestConverter:
     """Convert YOLO-Fastest Darknet models to ONNX"""
 
-    def __init__(self):
+    def __init__(self, fp16=False):
+        self.fp16 = fp16
         self.models = {
             "1": {
                 "name": "YOLO-Fastest-1.1",
@@ -72,35 +83,54 @@ class YOLOFastestConverter:
 
     def parse_cfg(self, cfg_file):
         """Parse Darknet .cfg file"""
-        blocks = []
-        with open(cfg_file, 'r') as f:
-            lines = f.readlines()
-            block = {}
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                if line.startswith('['):
-                    if block:
-                        blocks.append(block)
-                    block = {'type': line[1:-1].strip()}
+        # Darknet repeats section names ([convolutional], [route], ...), so each
+        # header is prefixed with its index to keep sections distinct and ordered
+        counter = itertools.count()
+
+        def numbered_lines(f):
+            for line in f:
+                stripped = line.strip()
+                if stripped.startswith('['):
+                    yield f"[{next(counter)}:{stripped[1:-1].strip()}]\n"
                 else:
-                    key, value = line.split('=')
-                    block[key.strip()] = value.strip()
-            if block:
-                blocks.append(block)
-        return blocks
+                    yield stripped + '\n'
+
+        cp = configparser.RawConfigParser(strict=False, allow_no_value=True, delimiters=('=',))
+        cp.optionxform = str  # keep key case as written
+        with open(cfg_file, 'r') as f:
+            cp.read_file(numbered_lines(f))
+        return [{'type': s.split(':', 1)[1], **dict(cp.items(s))} for s in cp.sections()]
 
     def load_weights(self, weights_file):
-        """Load Darknet weights"""
-        with open(weights_file, 'rb') as f:
-            # Read header
-            header = np.fromfile(f, dtype=np.int32, count=5)
-            weights = np.fromfile(f, dtype=np.float32)
+        """Load Darknet weights as a read-only memory map (layers copy only their own slice)"""
+        # Header: major, minor, revision (int32) + seen, which Darknet writes as
+        # int64 for version >= 0.2 (20 bytes total) and as int32 before that (16 bytes)
+        major, minor = np.fromfile(weights_file, dtype=np.int32, count=2)
+        seen_int64 = (major * 10 + minor) >= 2 and major < 1000 and minor < 1000
+        header_size = 20 if seen_int64 else 16
+        weights = np.memmap(weights_file, dtype=np.float32, mode='r', offset=header_size)
         return weights
 
-    def build_model_from_cfg(self, blocks):
-        """Build PyTorch model from Darknet config blocks"""
+    def load_darknet_weights(self, model, weights):
+        """Copy Darknet weights into the model's Conv/BN tensors (must run before Conv+BN fusion)"""
+        offsets, sizes, shapes, dests = darknet_weight_layout(model)
+        total = int(sizes.sum())
+        # A Darknet layout is only valid if it consumes the file exactly; anything else
+        # means the model does not match the cfg the weights were trained with
+        if total != len(weights):
+            print(f"⚠️  Model needs {total:,} weight values but file has {len(weights):,}, weights NOT loaded")
+            return False
+        
+        # Offsets/shapes are precomputed, so the loop only issues one slice copy per tensor
+        with torch.no_grad():
+            for off, n, shape, dst in zip(offsets.tolist(), sizes.tolist(), shapes, dests):
+                dst.copy_(torch.from_numpy(np.array(weights[off:off + n])).view(shape))
+        
+        print(f"   Loaded {total:,} weight values into {len(dests)} tensors")
+        return True
+
+    def build_model_from_cfg(self, blocks, weights=None):
+        """Build PyTorch model from Darknet config blocks, optionally loading Darknet weights"""
         net_info = blocks[0]
         input_size = int(net_info.get('width', 320))
         
@@ -108,7 +138,16 @@ class YOLOFastestConverter:
         
         # For simplicity, we'll use a placeholder model structure
         # In production, you'd need to parse each layer type properly
-        return SimplifiedYOLOFastest(input_size)
+        model = SimplifiedYOLOFastest(input_size).eval()
+        if weights is not None:
+            self.load_darknet_weights(model, weights)
+        
+        # Fold BatchNorm into the preceding Conv (and merge ReLU) so each block exports as one Conv
+        fuse_lists = find_fusable_modules(model)
+        if fuse_lists:
+            print(f"   Fusing {len(fuse_lists)} Conv+BN blocks")
+            model = fuse_modules(model, fuse_lists, inplace=False)
+        return model
 
     def convert(self, model_key):
         """Convert a specific model"""
@@ -148,7 +187,7 @@ class YOLOFastestConverter:
             
             # Build model
             print("🏗️  Building PyTorch model...")
-            model = self.build_model_from_cfg(blocks)
+            model = self.build_model_from_cfg(blocks, weights)
             model.eval()
             
             # Export to ONNX
@@ -156,12 +195,12 @@ class YOLOFastestConverter:
             input_size = 320  # YOLO-Fastest default
             dummy_input = torch.randn(1, 3, input_size, input_size)
             
-            torch.onnx.export(
+            exporter = export_onnx(
                 model,
                 dummy_input,
-                str(output_path),
+                output_path,
+                opset_version=17,
                 export_params=True,
-                opset_version=11,
                 do_constant_folding=True,
                 input_names=['images'],
                 output_names=['output'],
@@ -170,14 +209,35 @@ class YOLOFastestConverter:
                     'output': {0: 'batch'}
                 }
             )
+            print(f"   Exporter: {exporter}")
+            
+            # Move weights into a single sibling .data file
+            data_path = save_with_external_data(output_path)
             
             # Verify ONNX model
+            # (path-based APIs stream the file instead of loading all weights into Python)
             print("✅ Verifying ONNX model...")
-            onnx_model = onnx.load(str(output_path))
-            onnx.checker.check_model(onnx_model)
+            onnx.checker.check_model(str(output_path))
+            with atomic_write(output_path) as tmp_path:
+                onnx.shape_inference.infer_shapes_path(str(output_path), tmp_path)
             
-            print(f"✅ Successfully converted to: {output_path.name}")
-            print(f"   Output size: {output_path.stat().st_size / 1024 / 1024:.2f} MB")
+            print(f"✅ Successfully converted to: {output_path.name} (+ {data_path.name})")
+            print(f"   Output size: {model_size_mb(output_path):.2f} MB")
+            
+            # CPU-only ORT-optimized copy; the plain model above stays the main artifact
+            print("⚡ Optimizing graph (ORT_ENABLE_ALL)...")
+            opt_path = Path(optimize_onnx(output_path))
+            print(f"✅ CPU-optimized model: {opt_path.name}")
+            
+            # FP16 copy is optional: a failure here leaves the verified FP32 model in place
+            if self.fp16:
+                print("🔄 Converting to FP16...")
+                try:
+                    fp16_path = Path(convert_to_fp16(output_path))
+                    print(f"✅ FP16 model: {fp16_path.name}")
+                    print(f"   Output size: {fp16_path.stat().st_size / 1024 / 1024:.2f} MB")
+                except Exception as e:
+                    print(f"⚠️  FP16 conversion failed (FP32 model is still valid): {e}")
             return True
             
         except Exception as e:
@@ -204,6 +264,48 @@ class YOLOFastestConverter:
         return all(results.values())
 
 
+def darknet_weight_layout(model):
+    """Describe where each Darknet weight tensor lives in the flat weights array
+    
+    Darknet stores, per convolutional layer: [bn.bias, bn.weight, bn.running_mean, bn.running_var]
+    (or [conv.bias] without BN), followed by conv.weight.
+    Returns (offsets, sizes, shapes, dests) with offsets/sizes as int64 arrays.
+    """
+    layers = [m for m in model.modules() if isinstance(m, (nn.Conv2d, nn.BatchNorm2d))]
+    dests = []
+    for i, layer in enumerate(layers):
+        if not isinstance(layer, nn.Conv2d):
+            continue
+        bn = layers[i + 1] if i + 1 < len(layers) and isinstance(layers[i + 1], nn.BatchNorm2d) else None
+        if bn is not None:
+            dests += [bn.bias, bn.weight, bn.running_mean, bn.running_var]
+        elif layer.bias is not None:
+            dests.append(layer.bias)
+        dests.append(layer.weight)
+    
+    sizes = np.fromiter((t.numel() for t in dests), dtype=np.int64, count=len(dests))
+    offsets = np.cumsum(sizes) - sizes
+    shapes = [tuple(t.shape) for t in dests]
+    return offsets, sizes, shapes, dests
+
+
+def find_fusable_modules(model):
+    """Find (Conv2d, BatchNorm2d[, ReLU]) runs inside nn.Sequential containers for fuse_modules"""
+    fuse_lists = []
+    for prefix, module in model.named_modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules.keys())
+        layers = list(module._modules.values())
+        for i in range(len(layers) - 1):
+            if isinstance(layers[i], nn.Conv2d) and isinstance(layers[i + 1], nn.BatchNorm2d):
+                group = names[i:i + 2]
+                if i + 2 < len(layers) and isinstance(layers[i + 2], nn.ReLU):
+                    group.append(names[i + 2])
+                fuse_lists.append([f"{prefix}.{name}" if prefix else name for name in group])
+    return fuse_lists
+
+
 class SimplifiedYOLOFastest(nn.Module):
     """
     Simplified YOLO-Fastest model structure
@@ -254,7 +356,19 @@ def show_menu():
 
 def main():
     """Main conversion function"""
-    converter = YOLOFastestConverter()
+    parser = argparse.ArgumentParser(description="Convert YOLO-Fastest Darknet models to ONNX")
+    parser.add_argument(
+        "--fp16",
+        action="store_true",
+        help="Also export an FP16 model (*_fp16.onnx, FP32 inputs/outputs)"
+    )
+    args = parser.parse_args()
+    
+    if args.fp16 and not fp16_available():
+        print("❌ --fp16 requires onnxconverter-common: pip install onnxconverter-common")
+        sys.exit(1)
+    
+    converter = YOLOFastestConverter(fp16=args.fp16)
     
     print("\n⚠️  IMPORTANT NOTICE")
     print("="*60)
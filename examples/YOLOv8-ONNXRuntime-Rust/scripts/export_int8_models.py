@@ -9,8 +9,14 @@ Export YOLOv8 models to INT8 quantized ONNX format
 导出的模型会自动保存到 models/ 目录
 """
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from ultralytics import YOLO
+import errno
 import os
+import shutil
+import torch
+
+from onnx_utils import optimize_onnx
 
 def export_int8_model(model_path, output_dir='models'):
     """导出INT8量化ONNX模型"""
@@ -52,11 +58,20 @@ def export_int8_model(model_path, output_dir='models'):
         if os.path.exists(exported_path):
             os.makedirs(output_dir, exist_ok=True)
             
-            # 重命名并移动
-            import shutil
-            shutil.move(exported_path, target_path)
+            # 重命名并移动 (同一文件系统直接原子重命名, 跨文件系统才复制)
+            try:
+                os.replace(exported_path, target_path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(exported_path, target_path)
             print(f"📁 已保存到: {target_path}")
             
+            # 另存ORT优化后的图 (仅供CPU部署, 原模型保持不变)
+            print(f"⚡ ORT图优化 (ORT_ENABLE_ALL)...")
+            opt_path = optimize_onnx(target_path)
+            print(f"📁 CPU优化模型: {opt_path}")
+            
             # 显示文件大小
             size_mb = os.path.getsize(target_path) / (1024 * 1024)
             print(f"📊 模型大小: {size_mb:.2f} MB")
@@ -68,6 +83,11 @@ def export_int8_model(model_path, output_dir='models'):
         return False
 
 
+def _init_worker():
+    """子进程初始化: 单线程, 避免多个导出进程的线程池互相抢占CPU"""
+    torch.set_num_threads(1)
+
+
 def main():
     print("""
     ╔════════════════════════════════════════════════════════╗
@@ -94,18 +114,30 @@ def main():
     ]
     
     success_count = 0
-    total_count = 0
+    tasks = []
     
     for model_path, description in models_to_export:
-        print(f"\n🎯 {description}")
-        
         # 检查是否存在
         if os.path.exists(model_path):
-            total_count += 1
-            if export_int8_model(model_path):
-                success_count += 1
+            print(f"🎯 {description}: {model_path}")
+            tasks.append(model_path)
         else:
             print(f"⏭️  跳过 (文件不存在): {model_path}")
+    total_count = len(tasks)
+    
+    if tasks:
+        # 每个进程导出一个模型 (_init_worker 将各进程的torch线程数限制为1)
+        max_workers = max(1, min(len(tasks), (os.cpu_count() or 2) // 2))
+        print(f"\n🚀 并行导出 {len(tasks)} 个模型 (进程数: {max_workers})")
+        
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+            futures = {executor.submit(export_int8_model, model_path): model_path for model_path in tasks}
+            for future in as_completed(futures):
+                try:
+                    if future.result():
+                        success_count += 1
+                except Exception as e:
+                    print(f"❌ 导出进程异常: {futures[future]}: {e}")
     
     # 汇总
     print(f"\n{'='*60}")
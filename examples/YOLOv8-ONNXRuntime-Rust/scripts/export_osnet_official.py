@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 """
 使用官方torchreid库导出OSNet x0.25模型到ONNX格式
+
+使用方法:
+    python export_osnet_official.py
+    python export_osnet_official.py --fp16   # 同时导出FP16模型 (需要 onnxconverter-common)
 """
 
+import argparse
+import sys
+import time
+import numpy as np
+import onnx
+import onnxruntime as ort
 import torch
 import torch.onnx
 import torchreid
 
-def export_osnet_to_onnx():
+from onnx_utils import atomic_write, convert_to_fp16, export_onnx, fp16_available, optimize_onnx, save_with_external_data
+
+def export_osnet_to_onnx(fp16=False):
     """使用官方实现导出OSNet-AIN x1.0模型 (跨域泛化能力最强)"""
     print("🚀 开始导出OSNet-AIN x1.0模型到ONNX格式...")
     
@@ -21,8 +33,18 @@ def export_osnet_to_onnx():
     )
     
     # 加载预训练权重
-    print("📥 加载预训练权重: models/osnet_ain_x1_0_imagenet.pth")
-    checkpoint = torch.load('models/osnet_ain_x1_0_imagenet.pth', map_location='cpu')
+    weights_path = 'models/osnet_ain_x1_0_imagenet.pth'
+    print(f"📥 加载预训练权重: {weights_path}")
+    try:
+        # mmap直接映射权重文件, weights_only禁止执行任意pickle代码 (PyTorch >= 2.1)
+        checkpoint = torch.load(weights_path, map_location='cpu', mmap=True, weights_only=True)
+    except (TypeError, RuntimeError):
+        # PyTorch 1.13-2.0 不支持mmap参数, 旧格式(非zip)权重文件也不支持mmap; 仍保留weights_only
+        try:
+            checkpoint = torch.load(weights_path, map_location='cpu', weights_only=True)
+        except TypeError:
+            # PyTorch < 1.13 不支持weights_only参数
+            checkpoint = torch.load(weights_path, map_location='cpu')
     
     # 提取state_dict
     if 'state_dict' in checkpoint:
@@ -39,28 +61,18 @@ def export_osnet_to_onnx():
     # 创建示例输入 (batch_size=1, channels=3, height=256, width=128)
     print("📝 创建示例输入: [1, 3, 256, 128]")
     dummy_input = torch.randn(1, 3, 256, 128)
-    
-    # 测试前向传播
-    print("🧪 测试模型前向传播...")
-    with torch.no_grad():
-        output = model(dummy_input)
-        print(f"   输出形状: {output.shape}")
-        print(f"   输出范围: [{output.min():.4f}, {output.max():.4f}]")
-        
-        # 检查L2范数
-        l2_norm = torch.norm(output, p=2, dim=1)
-        print(f"   L2范数: {l2_norm.item():.4f}")
+    dummy_np = dummy_input.numpy()  # 与dummy_input共享内存, 供ORT推理复用
     
     # 导出ONNX
     output_path = "models/osnet_ain_x1_0.onnx"
     print(f"\n🔄 导出ONNX模型到: {output_path}")
     
-    torch.onnx.export(
+    exporter = export_onnx(
         model,
         dummy_input,
         output_path,
+        opset_version=17,
         export_params=True,
-        opset_version=12,
         do_constant_folding=True,
         input_names=['input'],
         output_names=['output'],
@@ -70,48 +82,122 @@ def export_osnet_to_onnx():
         },
         verbose=False
     )
+    print(f"   导出器: {exporter}")
+    
+    # 权重另存为单个外部数据文件
+    data_path = save_with_external_data(output_path)
+    
+    print(f"✅ ONNX导出成功! (权重文件: {data_path})")
     
-    print("✅ ONNX导出成功!")
+    # 另存ORT优化后的图 (仅供CPU部署, 原模型保持不变)
+    print("⚡ ORT图优化 (ORT_ENABLE_ALL)...")
+    opt_path = optimize_onnx(output_path)
+    print(f"✅ CPU优化模型: {opt_path}")
     
     # 验证ONNX模型
     print("\n🔍 验证ONNX模型...")
-    import onnx
-    onnx_model = onnx.load(output_path)
-    
     try:
-        onnx.checker.check_model(onnx_model)
+        # 传入路径而非ModelProto, 权重留在磁盘上, 不整体加载到Python
+        onnx.checker.check_model(output_path)
+        with atomic_write(output_path) as tmp_path:
+            onnx.shape_inference.infer_shapes_path(output_path, tmp_path)
         print("✅ ONNX模型验证通过")
     except Exception as e:
         print(f"⚠️  ONNX模型验证失败: {e}")
     
-    # 打印模型信息
+    # 打印模型信息 (只解析图结构, 不加载外部权重)
     print("\n📊 模型信息:")
+    onnx_model = onnx.load(output_path, load_external_data=False)
     print(f"   输入: {onnx_model.graph.input[0].name} - {[d.dim_value for d in onnx_model.graph.input[0].type.tensor_type.shape.dim]}")
     print(f"   输出: {onnx_model.graph.output[0].name} - {[d.dim_value for d in onnx_model.graph.output[0].type.tensor_type.shape.dim]}")
     
     # 测试ONNX推理
     print("\n🧪 测试ONNX推理...")
-    import onnxruntime as ort
-    
-    session = ort.InferenceSession(output_path, providers=['CPUExecutionProvider'])
-    onnx_output = session.run(
-        None,
-        {'input': dummy_input.numpy()}
-    )[0]
+    # 有GPU时使用TensorRT/CUDA验证, 同时提前暴露GPU上不支持的算子
+    providers = []
+    available_providers = ort.get_available_providers()
+    if 'TensorrtExecutionProvider' in available_providers:
+        providers.append(('TensorrtExecutionProvider', {
+            'trt_fp16_enable': True,
+            'trt_engine_cache_enable': True,
+            'trt_engine_cache_path': './trt_cache',
+        }))
+    if 'CUDAExecutionProvider' in available_providers:
+        providers.append('CUDAExecutionProvider')
+    providers.append('CPUExecutionProvider')
+    
+    session = ort.InferenceSession(output_path, providers=providers)
+    print(f"   执行提供者: {session.get_providers()}")
+    
+    # IOBinding: 输入输出绑定到预分配的OrtValue, 重复推理时不再分配/拷贝
+    io_binding = session.io_binding()
+    output_shape = (dummy_np.shape[0], *session.get_outputs()[0].shape[1:])
+    input_value = ort.OrtValue.ortvalue_from_numpy(dummy_np)
+    output_value = ort.OrtValue.ortvalue_from_shape_and_type(output_shape, np.float32)
+    io_binding.bind_ortvalue_input('input', input_value)
+    io_binding.bind_ortvalue_output('output', output_value)
+    
+    session.run_with_iobinding(io_binding)
+    onnx_output = output_value.numpy()
     
     print(f"   ONNX输出形状: {onnx_output.shape}")
     print(f"   ONNX输出范围: [{onnx_output.min():.4f}, {onnx_output.max():.4f}]")
     
-    # 比较PyTorch和ONNX输出
-    import numpy as np
-    pytorch_output = output.numpy()
-    diff = np.abs(pytorch_output - onnx_output).max()
-    print(f"   最大差异: {diff:.6f}")
+    # 简单性能测试 (复用IOBinding, 首次推理已作为预热)
+    num_runs = 50
+    start = time.perf_counter()
+    for _ in range(num_runs):
+        session.run_with_iobinding(io_binding)
+    elapsed_ms = (time.perf_counter() - start) * 1000 / num_runs
+    print(f"   平均推理耗时: {elapsed_ms:.2f} ms ({1000 / elapsed_ms:.1f} FPS, {num_runs}次)")
     
-    if diff < 1e-4:
+    # PyTorch前向传播 (仅此一次, 用于与ONNX对比)
+    with torch.no_grad():
+        pytorch_output = model(dummy_input).numpy()
+    print(f"   PyTorch输出形状: {pytorch_output.shape}")
+    print(f"   L2范数: {np.linalg.norm(pytorch_output, axis=1)[0]:.4f}")
+    
+    # 比较PyTorch和ONNX输出 (一致时直接通过, 不分配差值数组)
+    # TensorRT以FP16运行时, 与FP32 PyTorch的误差在1e-2量级, 使用FP16容差
+    if session.get_providers()[0] == 'TensorrtExecutionProvider':
+        atol, rtol = 1e-2, 1e-2
+    else:
+        atol, rtol = 1e-4, 0
+    print(f"   容差: atol={atol}, rtol={rtol}")
+    
+    if np.allclose(pytorch_output, onnx_output, atol=atol, rtol=rtol):
         print("✅ PyTorch和ONNX输出一致!")
     else:
-        print(f"⚠️  PyTorch和ONNX输出差异较大: {diff:.6f}")
+        diff = np.empty_like(pytorch_output)
+        np.subtract(pytorch_output, onnx_output, out=diff)
+        np.fabs(diff, out=diff)
+        print(f"⚠️  PyTorch和ONNX输出差异较大: {diff.max():.6f}")
+    
+    fp16_path = None
+    if fp16:
+        # FP16为可选产物: 转换失败时FP32模型仍然可用
+        print("\n🔄 转换FP16模型...")
+        try:
+            fp16_path = convert_to_fp16(output_path)
+        except Exception as e:
+            print(f"⚠️  FP16转换失败 (FP32模型不受影响): {e}")
+    
+    if fp16_path:
+        # 验证FP16模型 (输入输出保持FP32)
+        print("\n🧪 测试FP16模型...")
+        fp16_session = ort.InferenceSession(fp16_path, providers=['CPUExecutionProvider'])
+        fp16_output = fp16_session.run(None, {'input': dummy_np})[0]
+        
+        # 检查L2范数相对误差
+        fp32_norm = np.linalg.norm(onnx_output, axis=1)
+        fp16_norm = np.linalg.norm(fp16_output, axis=1)
+        norm_err = (np.abs(fp16_norm - fp32_norm) / fp32_norm).max()
+        print(f"   FP16 L2范数相对误差: {norm_err:.6f}")
+        
+        if norm_err < 1e-2:
+            print(f"✅ FP16模型已保存到: {fp16_path}")
+        else:
+            print(f"⚠️  FP16模型误差较大, 请谨慎使用: {fp16_path}")
     
     print("\n✨ 导出完成! ONNX模型已保存到: models/osnet_ain_x1_0.onnx")
     print("\n📊 OSNet-AIN x1.0 性能指标:")
@@ -123,4 +209,10 @@ def export_osnet_to_onnx():
     print("   - 相比标准x1.0: mAP +2.3%, 跨域性能显著提升")
 
 if __name__ == '__main__':
-    export_osnet_to_onnx()
+    parser = argparse.ArgumentParser(description='Export OSNet-AIN x1.0 to ONNX')
+    parser.add_argument('--fp16', action='store_true', help='同时导出FP16模型 (*_fp16.onnx)')
+    args = parser.parse_args()
+    if args.fp16 and not fp16_available():
+        print("❌ --fp16 需要 onnxconverter-common: pip install onnxconverter-common")
+        sys.exit(1)
+    export_osnet_to_onnx(fp16=args.fp16)
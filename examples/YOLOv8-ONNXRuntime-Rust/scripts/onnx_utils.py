@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+ONNX导出公共工具
+Shared helpers for the ONNX export scripts in this directory
+"""
+
+import importlib.util
+import inspect
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+import onnx
+import onnxruntime as ort
+
+
+@contextmanager
+def atomic_write(path):
+    """先写入 <path>.tmp, 成功后用os.replace原子替换目标文件; 中断或失败时删除临时文件
+    
+    避免Ctrl-C等中断留下半截模型文件
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def export_onnx(model, dummy_input, onnx_path, opset_version=17, **kwargs):
+    """导出ONNX模型, 返回使用的导出器名称
+    
+    PyTorch支持时 (>= 2.5, torch.onnx.export(dynamo=True)) 优先使用TorchDynamo导出器, 失败时回退到TorchScript导出器。
+    opset >= 17 可直接导出LayerNormalization等原生算子, 避免被拆成多个小算子。
+    Dynamo导出器无法降级到指定opset时会保留更高的opset, 实际写入的版本会打印出来
+    """
+    import torch  # 延迟导入: quantize_onnx_int8.py 等只做ONNX处理的脚本不依赖torch
+
+    exporter = None
+    supports_dynamo = 'dynamo' in inspect.signature(torch.onnx.export).parameters
+    if supports_dynamo:
+        try:
+            with atomic_write(onnx_path) as tmp_path:
+                # 权重先内嵌保存, 由 save_with_external_data 统一外置
+                torch.onnx.export(
+                    model, (dummy_input,), tmp_path,
+                    opset_version=opset_version, dynamo=True, external_data=False, **kwargs
+                )
+            exporter = 'dynamo'
+        except Exception as e:
+            print(f"⚠️  Dynamo导出失败, 回退到TorchScript导出器: {e}")
+
+    if exporter is None:
+        # 新版PyTorch默认 dynamo=True, 回退时必须显式关闭
+        if supports_dynamo:
+            kwargs['dynamo'] = False
+        with atomic_write(onnx_path) as tmp_path:
+            torch.onnx.export(model, dummy_input, tmp_path, opset_version=opset_version, **kwargs)
+        exporter = 'torchscript'
+
+    _report_opset(onnx_path, opset_version)
+    return exporter
+
+
+def _report_opset(onnx_path, requested):
+    """打印导出模型实际的 ai.onnx opset 版本"""
+    model = onnx.load(str(onnx_path), load_external_data=False)
+    opset = next((o.version for o in model.opset_import if o.domain in ('', 'ai.onnx')), 0)
+    if opset == requested:
+        print(f"   opset: {opset}")
+    else:
+        print(f"⚠️  opset: {opset} (请求 {requested}, 导出器未能转换到请求的版本)")
+
+
+def fp16_available():
+    """convert_to_fp16 所需的可选依赖 onnxconverter-common 是否已安装"""
+    return importlib.util.find_spec('onnxconverter_common') is not None
+
+
+def convert_to_fp16(onnx_path):
+    """将FP32 ONNX模型转换为FP16 (输入输出保持FP32), 返回 *_fp16.onnx 路径"""
+    from onnxconverter_common import float16  # 可选依赖: pip install onnxconverter-common
+
+    onnx_path = str(onnx_path)
+    fp16_path = onnx_path.replace('.onnx', '_fp16.onnx')
+
+    model = onnx.load(onnx_path)
+    # keep_io_types=True: 调用方无需修改预处理
+    fp16_model = float16.convert_float_to_float16(model, keep_io_types=True, disable_shape_infer=False)
+    with atomic_write(fp16_path) as tmp_path:
+        onnx.save(fp16_model, tmp_path)
+    return fp16_path
+
+
+def optimize_onnx(onnx_path):
+    """用ORT_ENABLE_ALL离线优化图 (Conv+BN+Act融合, Gemm融合, 布局转换), 另存为 *_opt.onnx 并返回其路径
+    
+    CPU部署时加载 *_opt.onnx 可省去重复融合, 减少首次推理延迟。优化结果包含ORT专用算子和CPU专用的NCHWc布局,
+    只适合在导出机器上用CPU运行, 因此不覆盖原模型 (原模型仍用于GPU/TensorRT、FP16转换和INT8量化)
+    """
+    onnx_path = str(onnx_path)
+    opt_path = onnx_path.replace('.onnx', '_opt.onnx')
+
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    with atomic_write(opt_path) as tmp_path:
+        so.optimized_model_filepath = tmp_path
+        ort.InferenceSession(onnx_path, so, providers=['CPUExecutionProvider'])
+    return opt_path
+
+
+def save_with_external_data(onnx_path):
+    """将权重另存为同目录下单个 .data 文件, 返回 .data 路径
+    
+    避免protobuf 2GB上限, 且ORT加载时可直接mmap权重文件
+    """
+    onnx_path = Path(onnx_path)
+    data_path = onnx_path.with_suffix('.data')
+
+    # 默认加载外部数据: torch导出超大模型时可能已生成零散权重文件, 在此合并为一个
+    model = onnx.load(str(onnx_path))
+    # onnx以追加模式写外部数据, 重复导出前需删除旧文件
+    data_path.unlink(missing_ok=True)
+    with atomic_write(onnx_path) as tmp_path:
+        onnx.save_model(
+            model,
+            tmp_path,
+            save_as_external_data=True,
+            all_tensors_to_one_file=True,
+            location=data_path.name,
+            size_threshold=1024,
+            convert_attribute=False,
+        )
+    return data_path
+
+
+def model_size_mb(onnx_path):
+    """模型总大小 (MB), 包含外部权重文件"""
+    onnx_path = Path(onnx_path)
+    data_path = onnx_path.with_suffix('.data')
+    size = onnx_path.stat().st_size + (data_path.stat().st_size if data_path.exists() else 0)
+    return size / 1024 / 1024
@@ -5,14 +5,146 @@ Quantize existing ONNX models to INT8 format
 
 使用方法:
     python quantize_onnx_int8.py
+    python quantize_onnx_int8.py --calib-dir datasets/coco/images/val2017
     
 从 models/ 目录读取ONNX模型,导出INT8量化版本
+YOLOv5/v8/v10/11 模型使用校准图片做静态量化 (QDQ格式);
+其他模型 (预处理不同) 或校准目录不存在时使用动态量化
 """
 
+import argparse
+import glob
 import os
-from onnxruntime.quantization import quantize_dynamic, QuantType
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def quantize_onnx_model(input_path, output_path):
+import cv2
+import numpy as np
+import onnx
+from onnx import version_converter
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    CalibrationMethod,
+    QuantFormat,
+    QuantType,
+    quantize_dynamic,
+    quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from onnx_utils import atomic_write, model_size_mb
+
+IMAGE_EXTENSIONS = ('*.jpg', '*.jpeg', '*.png', '*.bmp')
+
+# Percentile校准会把每张图片的全部中间激活保留在内存中直到校准结束
+# (yolov8n@320 约60MB/张, m/l/x 为数倍), 默认图片数保持较小
+DEFAULT_NUM_CALIB = 32
+
+# 按通道量化需要 DequantizeLinear 的 axis 属性 (opset 13 起)
+PER_CHANNEL_MIN_OPSET = 13
+
+# 预处理与 Yolov8CalibReader 一致 (letterbox + RGB + /255) 的模型: YOLOv5/v8/v10/11 检测/姿态
+YOLO_MODEL_PATTERN = re.compile(r'^yolo(v5|v8|v10|v11|11)', re.IGNORECASE)
+
+
+def uses_yolo_preprocessing(model_path):
+    """判断模型输入预处理是否与 Yolov8CalibReader 一致
+    
+    OSNet (ImageNet均值/方差)、NanoDet、YOLOX、YOLO-Fastest 等预处理不同, 用错误分布校准会得到错误的激活范围
+    """
+    if YOLO_MODEL_PATTERN.match(os.path.basename(model_path)):
+        return True
+    # Ultralytics导出的模型在metadata中记录author
+    model = onnx.load(model_path, load_external_data=False)
+    metadata = {p.key: p.value for p in model.metadata_props}
+    return 'ultralytics' in metadata.get('author', '').lower()
+
+
+class Yolov8CalibReader(CalibrationDataReader):
+    """从图片目录读取校准数据 (letterbox + /255, NCHW float32)"""
+
+    def __init__(self, model_path, calib_dir, num_images=DEFAULT_NUM_CALIB, imgsz=320):
+        # 从模型读取输入名和尺寸 (动态维度使用imgsz)
+        model = onnx.load(model_path, load_external_data=False)
+        model_input = model.graph.input[0]
+        dims = [d.dim_value for d in model_input.type.tensor_type.shape.dim]
+        self.input_name = model_input.name
+        self.height = dims[2] if len(dims) == 4 and dims[2] > 0 else imgsz
+        self.width = dims[3] if len(dims) == 4 and dims[3] > 0 else imgsz
+
+        files = []
+        for ext in IMAGE_EXTENSIONS:
+            files.extend(glob.glob(os.path.join(calib_dir, ext)))
+        self.files = sorted(files)[:num_images]
+        self.iterator = iter(self.files)
+
+    def letterbox(self, img):
+        """等比缩放并填充到模型输入尺寸"""
+        h, w = img.shape[:2]
+        r = min(self.height / h, self.width / w)
+        new_h, new_w = int(round(h * r)), int(round(w * r))
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+        top = (self.height - new_h) // 2
+        left = (self.width - new_w) // 2
+        return cv2.copyMakeBorder(
+            img, top, self.height - new_h - top, left, self.width - new_w - left,
+            cv2.BORDER_CONSTANT, value=(114, 114, 114)
+        )
+
+    def get_next(self):
+        for path in self.iterator:
+            img = cv2.imread(path)
+            if img is None:
+                continue
+            img = self.letterbox(img)[:, :, ::-1]  # BGR -> RGB
+            img = np.ascontiguousarray(img.transpose(2, 0, 1), dtype=np.float32) / 255.0
+            return {self.input_name: img[None]}
+        return None
+
+    def rewind(self):
+        self.iterator = iter(self.files)
+
+
+def _opset_version(model):
+    """模型默认域 (ai.onnx) 的opset版本"""
+    return next((o.version for o in model.opset_import if o.domain in ('', 'ai.onnx')), 0)
+
+
+def _preprocess(input_path, work_dir):
+    """量化前预处理: 符号形状推理 + 常量折叠 + 图优化, 返回预处理后的模型路径
+    
+    消除动态形状算子、冗余Cast和未融合的Conv+BN, 减少量化边界(FP<->INT8转换)
+    """
+    print(f"🔧 预处理模型 (形状推理 + 常量折叠 + 图优化)...")
+    preprocessed_path = os.path.join(work_dir, os.path.basename(input_path))
+    quant_pre_process(
+        input_path,
+        preprocessed_path,
+        skip_optimization=False,
+        skip_onnx_shape=False,
+        skip_symbolic_shape=False,
+        auto_merge=True,
+    )
+    
+    # 显示预处理前后节点数
+    before = len(onnx.load(input_path, load_external_data=False).graph.node)
+    graph_only = onnx.load(preprocessed_path, load_external_data=False)
+    print(f"   节点数: {before} -> {len(graph_only.graph.node)}")
+    
+    # 旧模型 (如 export_int8_models.py / YOLOv5 导出的opset 12) 升级到opset 13, 以便按通道量化
+    opset = _opset_version(graph_only)
+    if opset < PER_CHANNEL_MIN_OPSET:
+        try:
+            model = version_converter.convert_version(onnx.load(preprocessed_path), PER_CHANNEL_MIN_OPSET)
+            onnx.save(model, preprocessed_path)
+            print(f"   opset: {opset} -> {PER_CHANNEL_MIN_OPSET}")
+        except Exception as e:
+            print(f"⚠️  opset {opset} 升级失败, 将使用按张量量化: {e}")
+    return preprocessed_path
+
+
+def quantize_onnx_model(input_path, output_path, calib_dir='calib_images', num_calib=DEFAULT_NUM_CALIB):
     """量化ONNX模型到INT8"""
     print(f"\n{'='*60}")
     print(f"📦 输入模型: {input_path}")
@@ -22,22 +154,62 @@ def quantize_onnx_model(input_path, output_path):
         print(f"❌ 模型文件不存在: {input_path}")
         return False
     
-    # 显示原始模型大小
-    size_mb = os.path.getsize(input_path) / (1024 * 1024)
+    # 显示原始模型大小 (包含外部权重 .data 文件)
+    size_mb = model_size_mb(input_path)
     print(f"📊 原始大小: {size_mb:.2f} MB")
     
     try:
-        print(f"🔄 开始INT8动态量化...")
-        
-        # 动态量化(无需校准数据)
-        quantize_dynamic(
-            model_input=input_path,
-            model_output=output_path,
-            weight_type=QuantType.QUInt8  # 使用无符号INT8
-        )
+        # 先写临时文件, 验证通过后原子替换; 中断时不会留下被"已存在"检查跳过的半截模型
+        with atomic_write(output_path) as tmp_output_path, tempfile.TemporaryDirectory() as tmp_dir:
+            preprocessed_path = _preprocess(input_path, tmp_dir)
+            
+            reader = None
+            if uses_yolo_preprocessing(input_path):
+                reader = Yolov8CalibReader(preprocessed_path, calib_dir, num_images=num_calib)
+            
+            if reader is not None and reader.files:
+                print(f"🔄 开始INT8静态量化 (校准图片: {len(reader.files)} 张)...")
+                
+                # opset < 13 时 DequantizeLinear 没有axis属性, 只能按张量量化
+                opset = _opset_version(onnx.load(preprocessed_path, load_external_data=False))
+                per_channel = opset >= PER_CHANNEL_MIN_OPSET
+                if not per_channel:
+                    print(f"ℹ️  opset < {PER_CHANNEL_MIN_OPSET}, 权重按张量量化")
+                
+                # 静态量化: 激活+权重均为INT8, 按通道对称权重
+                # 只量化Conv/MatMul: 检测头的Sigmoid/Concat/DFL保持FP32, 否则output0中
+                # 框坐标(0-500)和类别分数(0-1)共用一个uint8 scale, 分数全部被量化成同一个值
+                quantize_static(
+                    model_input=preprocessed_path,
+                    model_output=tmp_output_path,
+                    calibration_data_reader=reader,
+                    quant_format=QuantFormat.QDQ,
+                    op_types_to_quantize=['Conv', 'MatMul'],
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    per_channel=per_channel,
+                    reduce_range=False,
+                    calibrate_method=CalibrationMethod.Percentile,
+                    extra_options={'ActivationSymmetric': False, 'WeightSymmetric': True},
+                )
+            else:
+                if reader is None:
+                    print(f"ℹ️  非YOLO预处理模型, 校准数据不适用")
+                else:
+                    print(f"⚠️  未找到校准图片: {calib_dir}")
+                print(f"🔄 使用INT8动态量化...")
+                
+                # 动态量化(无需校准数据)
+                quantize_dynamic(
+                    model_input=preprocessed_path,
+                    model_output=tmp_output_path,
+                    weight_type=QuantType.QUInt8  # 使用无符号INT8
+                )
+            
+            # 验证量化后的模型
+            onnx.checker.check_model(tmp_output_path)
         
-        # 验证量化后的模型
-        quantized_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+        quantized_size_mb = model_size_mb(output_path)
         compression_ratio = size_mb / quantized_size_mb
         
         print(f"✅ 量化成功: {output_path}")
@@ -54,6 +226,13 @@ def quantize_onnx_model(input_path, output_path):
 
 
 def main():
+    parser = argparse.ArgumentParser(description='ONNX INT8 Quantization Tool')
+    parser.add_argument('--calib-dir', default='calib_images', help='校准图片目录 (如 COCO val2017)')
+    parser.add_argument('--num-calib', type=int, default=DEFAULT_NUM_CALIB,
+                        help=f'校准图片数量 (默认: {DEFAULT_NUM_CALIB}; 内存占用随图片数线性增长)')
+    parser.add_argument('--workers', type=int, default=2, help='并行进程数 (默认: 2)')
+    args = parser.parse_args()
+    
     print("""
     ╔════════════════════════════════════════════════════════╗
     ║         ONNX模型 INT8 量化工具                         ║
@@ -63,10 +242,11 @@ def main():
     
     models_dir = 'models'
     
-    # 查找所有ONNX模型(排除已量化的)
+    # 查找所有ONNX模型(排除已量化的、FP16的和ORT优化后的)
     onnx_models = []
     for filename in os.listdir(models_dir):
-        if filename.endswith('.onnx') and '_int8' not in filename:
+        if (filename.endswith('.onnx') and '_int8' not in filename
+                and '_fp16' not in filename and not filename.endswith('_opt.onnx')):
             onnx_models.append(filename)
     
     if not onnx_models:
@@ -78,6 +258,7 @@ def main():
         print(f"   - {model}")
     
     success_count = 0
+    tasks = []
     
     for model_name in onnx_models:
         input_path = os.path.join(models_dir, model_name)
@@ -92,9 +273,26 @@ def main():
             print(f"\n⏭️  跳过 (已存在): {output_name}")
             continue
         
-        # 量化模型
-        if quantize_onnx_model(input_path, output_path):
-            success_count += 1
+        tasks.append((input_path, output_path))
+    
+    if tasks:
+        # 每个进程量化一个模型。quant_pre_process和校准器内部创建的InferenceSession无法设置线程数,
+        # 每个都会占满全部CPU核, 进程数多了只会互相抢占; 默认2个进程, 让一个进程的单线程阶段
+        # (形状推理、图改写、保存) 与另一个进程的ORT校准重叠
+        max_workers = max(1, min(len(tasks), args.workers))
+        print(f"\n🚀 并行量化 {len(tasks)} 个模型 (进程数: {max_workers})")
+        
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(quantize_onnx_model, input_path, output_path, args.calib_dir, args.num_calib): input_path
+                for input_path, output_path in tasks
+            }
+            for future in as_completed(futures):
+                try:
+                    if future.result():
+                        success_count += 1
+                except Exception as e:
+                    print(f"❌ 量化进程异常: {futures[future]}: {e}")
     
     # 汇总
     print(f"\n{'='*60}")